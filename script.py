@@ -1,77 +1,248 @@
-import requests
-from bs4 import BeautifulSoup
+import asyncio
+import aiohttp
+from lxml import etree
+import codecs
 import csv
+import hashlib
+import os
 import time
 
-def estrai_info_pagina_dettaglio(url):
+MAX_TENTATIVI = 3
+BACKOFF = 0.5
+ATTESA_MASSIMA = 60
+STATI_TRANSITORI = [429, 500, 502, 503, 504]
+
+RICHIESTE_AL_SECONDO = 2
+MAX_CONCORRENZA = 10
+CACHE_DIR = '.cache'
+CACHE_TTL = 86400
+FILE_VISTI = 'seen.txt'
+
+def percorso_cache(url):
+    return os.path.join(CACHE_DIR, hashlib.sha1(url.encode('utf-8')).hexdigest() + '.html')
+
+# Ogni file di cache inizia con una riga "encoding:<charset>" con il charset
+# dichiarato dal server (vuoto se assente), seguita dai byte della pagina.
+def leggi_cache(url):
+    percorso = percorso_cache(url)
+    if os.path.exists(percorso) and time.time() - os.path.getmtime(percorso) < CACHE_TTL:
+        with open(percorso, 'rb') as f:
+            intestazione, _, contenuto = f.read().partition(b'\n')
+        if intestazione.startswith(b'encoding:'):
+            return contenuto, intestazione[len(b'encoding:'):].decode('ascii') or None
+    return None, None
+
+def scrivi_cache(url, contenuto, encoding):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    percorso = percorso_cache(url)
+    temporaneo = f"{percorso}.{os.getpid()}.tmp"
+    with open(temporaneo, 'wb') as f:
+        f.write(b'encoding:' + (encoding or '').encode('ascii') + b'\n')
+        f.write(contenuto)
+    os.replace(temporaneo, percorso)
+
+# libxml2 non conosce tutti gli alias accettati da Python (es. "latin-1"):
+# si passa il nome canonico e, se non basta, si lascia leggere il <meta charset>.
+def parse_html(contenuto, encoding):
+    parser = None
+    if encoding:
+        try:
+            parser = etree.HTMLParser(encoding=codecs.lookup(encoding).name)
+        except LookupError:
+            pass
+    return etree.fromstring(contenuto, parser or etree.HTMLParser())
+
+def con_classe(nome):
+    return f'contains(concat(" ", normalize-space(@class), " "), " {nome} ")'
+
+def testo_di(elemento):
+    return ''.join(t.strip() for t in elemento.itertext())
+
+XPATH_CONTATTI = etree.XPath(f'.//*[{con_classe("box-body")}]//*[{con_classe("list-group")}]')
+XPATH_PARAGRAFI = etree.XPath('.//p')
+XPATH_LINK_TEL = etree.XPath('.//a[starts-with(@href, "tel:")]')
+XPATH_INFO_BOX = etree.XPath(f'.//*[{con_classe("info-box")}]')
+XPATH_NOME = etree.XPath('.//h4//a')
+
+class TokenBucket:
+    def __init__(self, rate, capacita=1):
+        self.rate = rate
+        self.capacita = capacita
+        self.token = capacita
+        self.ultimo = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                ora = time.monotonic()
+                self.token = min(self.capacita, self.token + (ora - self.ultimo) * self.rate)
+                self.ultimo = ora
+                if self.token >= 1:
+                    self.token -= 1
+                    return
+                await asyncio.sleep((1 - self.token) / self.rate)
+
+async def scarica_con_retry(session, bucket, url):
+    for tentativo in range(MAX_TENTATIVI + 1):
+        ultimo = tentativo == MAX_TENTATIVI
+        await bucket.acquire()
+        try:
+            async with session.get(url, timeout=aiohttp.ClientTimeout(total=15)) as response:
+                if response.status in STATI_TRANSITORI and not ultimo:
+                    retry_after = response.headers.get('Retry-After', '')
+                    attesa = min(int(retry_after), ATTESA_MASSIMA) if retry_after.isdigit() else BACKOFF * 2 ** tentativo
+                    motivo = f"HTTP {response.status}"
+                else:
+                    response.raise_for_status()
+                    return await response.read(), response.charset
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            if ultimo:
+                raise
+            attesa = BACKOFF * 2 ** tentativo
+            motivo = repr(e)
+        print(f"⚠️ {url} → {motivo}, nuovo tentativo tra {attesa}s")
+        await asyncio.sleep(attesa)
+
+async def estrai_info_pagina_dettaglio(session, bucket, url):
     try:
-        response = requests.get(url, timeout=15)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.text, 'html.parser')
-        box = soup.select_one('.box-body .list-group')
+        html, encoding = leggi_cache(url)
+        dalla_rete = html is None
+        if dalla_rete:
+            html, encoding = await scarica_con_retry(session, bucket, url)
+        root = parse_html(html, encoding)
+        if root is None:
+            raise ValueError("pagina vuota")
+        if dalla_rete:
+            scrivi_cache(url, html, encoding)
+        box = XPATH_CONTATTI(root)
         indirizzo = telefono = email = sito_web = ""
         if box:
-            blocchi = box.find_all('p')
+            blocchi = XPATH_PARAGRAFI(box[0])
             for p in blocchi:
-                testo = p.get_text(strip=True)
+                testo = testo_di(p)
                 if not testo:
-                    a = p.find('a')
-                    if a:
-                        testo = a.get_text(strip=True)
+                    a = p.find('.//a')
+                    if a is not None:
+                        testo = testo_di(a)
                 if "@" in testo:
                     email = testo
                 elif "http" in testo:
                     sito_web = testo
-                elif p.find('a', href=lambda x: x and x.startswith('tel:')):
+                elif XPATH_LINK_TEL(p):
                     telefono = testo
                 elif not indirizzo:
                     indirizzo = testo
 
         return indirizzo, telefono, email, sito_web
 
+    # Gli errori temporanei (retry esauriti, timeout, connessione) restituiscono
+    # None: l'espositore non viene segnato come visto e si riprova al prossimo
+    # avvio. Quelli permanenti (4xx, pagina non valida) producono una riga vuota.
+    except aiohttp.ClientResponseError as e:
+        print(f"❌ Errore su {url}: {e}")
+        if e.status in STATI_TRANSITORI:
+            return None
+        return "", "", "", ""
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"❌ Errore temporaneo su {url}: {e!r}")
+        return None
     except Exception as e:
         print(f"❌ Errore su {url}: {e}")
         return "", "", "", ""
 
-def estrai_espositori_da_pagina(numero_pagina):
+async def estrai_espositori_da_pagina(session, bucket, numero_pagina):
     url = f'https://catalogo.fiereparma.it/manifestazione/cibus-2024/?pag={numero_pagina}'
     print(f"\n📄 Scansione pagina {numero_pagina}: {url}")
-    response = requests.get(url)
-    if response.status_code == 404:
-        return None
-    response.raise_for_status()
+    html, encoding = leggi_cache(url)
+    dalla_rete = html is None
+    if dalla_rete:
+        try:
+            html, encoding = await scarica_con_retry(session, bucket, url)
+        except aiohttp.ClientResponseError as e:
+            if e.status == 404:
+                return None, dalla_rete
+            raise
 
-    soup = BeautifulSoup(response.text, 'html.parser')
+    root = parse_html(html, encoding)
+    if root is None:
+        return None, dalla_rete
+    if dalla_rete:
+        scrivi_cache(url, html, encoding)
     espositori = []
 
-    for box in soup.select('.info-box'):
-        nome_tag = box.select_one('h4 a')
+    for box in XPATH_INFO_BOX(root):
+        nome_tag = XPATH_NOME(box)
         if nome_tag:
-            nome = nome_tag.get_text(strip=True)
-            link = nome_tag['href']
+            nome = testo_di(nome_tag[0])
+            link = nome_tag[0].attrib['href']
             espositori.append((nome, link))
 
-    return espositori if espositori else None
+    return (espositori if espositori else None), dalla_rete
 
-if __name__ == "__main__":
+async def estrai_dettaglio_limitato(session, semaforo, bucket, nome, link):
+    async with semaforo:
+        print(f"🔍 [{nome}] → {link}")
+        info = await estrai_info_pagina_dettaglio(session, bucket, link)
+        if info is None:
+            return None
+        return [nome, link, *info]
+
+async def main():
     pagina = 1
     file_output = 'espositori_cibus2024_completo.csv'
-    with open(file_output, mode='w', newline='', encoding='utf-8') as file:
-        writer = csv.writer(file)
-        writer.writerow(['Nome Espositore', 'Link', 'Indirizzo', 'Telefono', 'Email', 'Sito Web'])
-        while True:
-            espositori = estrai_espositori_da_pagina(pagina)
-            if not espositori:
-                print("\n✅ Nessuna altra pagina da analizzare. Fine.")
-                break
-            for count, (nome, link) in enumerate(espositori, start=1):
-                print(f"🔍 [{nome}] → {link}")
-                indirizzo, telefono, email, sito = estrai_info_pagina_dettaglio(link)
-                writer.writerow([nome, link, indirizzo, telefono, email, sito])
-                print("⏳ Attesa 60 secondi prima del prossimo espositore...")
-                time.sleep(60)
-
-            pagina += 1
-            print("➡️ Passo alla pagina successiva...")
-            time.sleep(5)
-    print(f"\n✅ File CSV completo salvato in: {file_output}")
+    visti = set()
+    if os.path.exists(FILE_VISTI) and os.path.exists(file_output):
+        with open(FILE_VISTI, encoding='utf-8') as f:
+            visti = set(f.read().splitlines())
+    ripresa = bool(visti)
+    if ripresa:
+        print(f"♻️ Ripresa: {len(visti)} espositori già salvati verranno saltati.")
+    programmati = set(visti)
+    rimandati = 0
+    semaforo = asyncio.Semaphore(MAX_CONCORRENZA)
+    bucket = TokenBucket(RICHIESTE_AL_SECONDO)
+    connector = aiohttp.TCPConnector(limit=MAX_CONCORRENZA)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        with open(file_output, mode='a' if ripresa else 'w', newline='', encoding='utf-8') as file, \
+                open(FILE_VISTI, mode='a' if ripresa else 'w', encoding='utf-8') as file_visti:
+            writer = csv.writer(file)
+            if not ripresa:
+                writer.writerow(['Nome Espositore', 'Link', 'Indirizzo', 'Telefono', 'Email', 'Sito Web'])
+            while True:
+                espositori, dalla_rete = await estrai_espositori_da_pagina(session, bucket, pagina)
+                if not espositori:
+                    print("\n✅ Nessuna altra pagina da analizzare. Fine.")
+                    break
+                richieste = []
+                for nome, link in espositori:
+                    if link in programmati:
+                        continue
+                    programmati.add(link)
+                    richieste.append(asyncio.create_task(
+                        estrai_dettaglio_limitato(session, semaforo, bucket, nome, link)
+                    ))
+                # Le richieste girano in parallelo, ma le righe vanno scritte
+                # nell'ordine del catalogo appena sono pronte quelle precedenti.
+                for richiesta in richieste:
+                    riga = await richiesta
+                    if riga is None:
+                        rimandati += 1
+                        continue
+                    writer.writerow(riga)
+                    file.flush()
+                    file_visti.write(riga[1] + '\n')
+                    file_visti.flush()
+
+                pagina += 1
+                print("➡️ Passo alla pagina successiva...")
+                if dalla_rete:
+                    await asyncio.sleep(5)
+    if rimandati:
+        print(f"\n⚠️ {rimandati} espositori saltati per errori temporanei: rilancia lo script per riprovarli.")
+        print(f"💾 File CSV parziale salvato in: {file_output}")
+    else:
+        print(f"\n✅ File CSV completo salvato in: {file_output}")
+
+if __name__ == "__main__":
+    asyncio.run(main())